@@ -2,12 +2,11 @@ from __future__ import annotations
 
 import math
 from dataclasses import dataclass
-from functools import lru_cache, partial, reduce
-from typing import Optional
+from functools import lru_cache, partial
+from typing import Callable, Optional
 
 import torch
 import torch.nn as nn
-from einops import rearrange
 from ezgatr.nn import EquiLinear, EquiRMSNorm
 from ezgatr.nn.functional import (
     equi_join,
@@ -34,6 +33,7 @@ class FaceTokenConfig:
     num_codebook_codes: int = 1024
     num_codebook_heads: int = 4
     ema_decay: float = 0.99
+    compile_layers: bool = False
 
 
 @lru_cache(maxsize=None, typed=True)
@@ -58,7 +58,39 @@ def _compute_tv_selector(device: torch.device) -> torch.Tensor:
 def _flatten_mv(mv: torch.Tensor) -> torch.Tensor:
     r"""Shortcut for flattening multi-vector dimensions."""
 
-    return rearrange(mv, "... c k -> ... (c k)")
+    return mv.flatten(-2)
+
+
+def _compute_bilinear_basis(
+    op: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+) -> torch.Tensor:
+    r"""Recover the ``(16, 16, 16)`` structure tensor of a bilinear multi-vector map.
+
+    Parameters
+    ----------
+    op : Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+        Bilinear map between two batches of multi-vectors, e.g., ``geometric_product``.
+
+    Returns
+    -------
+    torch.Tensor
+        Basis ``b`` of shape ``(16, 16, 16)`` such that ``op(x, y)`` equals
+        ``einsum("ijk, ...j, ...k -> ...i", b, x, y)``.
+    """
+    eye = torch.eye(16)
+    return op(eye[:, None, :], eye[None, :, :]).permute(2, 0, 1).contiguous()
+
+
+def _split_heads(mv: torch.Tensor, num_heads: int) -> torch.Tensor:
+    r"""Shortcut for reshaping ``(B, (H * D), 16)`` into ``((B * H), D, 16)``."""
+
+    return mv.unflatten(1, (num_heads, -1)).flatten(0, 1)
+
+
+def _merge_heads(mv: torch.Tensor, num_heads: int) -> torch.Tensor:
+    r"""Shortcut for reshaping ``((B * H), D, 16)`` into ``(B, (H * D), 16)``."""
+
+    return mv.unflatten(0, (-1, num_heads)).flatten(1, 2)
 
 
 def _compute_ip_elem(x_or_e: torch.Tensor) -> torch.Tensor:
@@ -227,12 +259,7 @@ class FaceTokenVQ(nn.Module):
         .. [1] `"Neural Discrete Representation Learning", Van Den Oord et al., 2018
             <https://arxiv.org/abs/2305.18415>`_
         """
-        x_flat = rearrange(
-            x, "b (h d) k -> (b h) d k",
-            h=self.config.num_codebook_heads,
-            d=self.config.codebook_size,
-            k=16,
-        )
+        x_flat = _split_heads(x, self.config.num_codebook_heads)
 
         # Let's perform a grade-mixing first to make sure the 'e_0' blades are updated
         e = self.proj_m(self.codebook)
@@ -242,23 +269,13 @@ class FaceTokenVQ(nn.Module):
         #     so we should do an 'argmax' operation. Then followed by straight-through
         #     gradient component.
         i = compute_xe_dist(x_flat, e).argmax(dim=-1).squeeze()
-        e = rearrange(
-            e[i],
-            "(b h) d k -> b (h d) k",
-            h=self.config.num_codebook_heads,
-            d=self.config.codebook_size,
-            k=16,
-        )
+        e = _merge_heads(e[i], self.config.num_codebook_heads)
         return e, (e - x).detach() + x
 
     @torch.no_grad
     def lookup(self, i: torch.LongTensor) -> torch.Tensor:
-        return rearrange(
-            self.proj_m(self.codebook[i]).detach(),
-            "(b h) d k -> b (h d) k",
-            h=self.config.num_codebook_heads,
-            d=self.config.codebook_size,
-            k=16,
+        return _merge_heads(
+            self.proj_m(self.codebook[i]).detach(), self.config.num_codebook_heads
         )
 
 
@@ -279,19 +296,32 @@ class FaceTokenBilinear(nn.Module):
             msg = f"Intermediate size must be even, got <{config.intermediate_size}>."
             raise ValueError(msg)
 
+        self.half_inter = config.intermediate_size // 2
         self.proj_b = EquiLinear(config.hidden_size, config.intermediate_size * 2)
         self.proj_o = EquiLinear(config.intermediate_size, config.hidden_size)
 
-    def forward(self, f_or_z, r):
-        geom_l, geom_r, join_l, join_r = torch.split(
-            self.proj_b(f_or_z),
-            split_size_or_sections=self.config.intermediate_size // 2,
-            dim=-2,
+        # The structure tensors are materialized once here rather than looked up
+        #     (or lazily loaded from disk) by ``ezgatr`` on every call, which also
+        #     keeps the whole layer traceable for ``torch.compile``.
+        self.register_buffer(
+            "basis_gp", _compute_bilinear_basis(geometric_product), persistent=False
         )
-        f_or_z = torch.cat(
-            [geometric_product(geom_l, geom_r), equi_join(join_l, join_r, r)],
-            dim=-2,
+        self.register_buffer(
+            "basis_jn", _compute_bilinear_basis(equi_join), persistent=False
         )
+
+    def forward(self, f_or_z, r):
+        n = self.half_inter
+        geom_l, geom_r, join_l, join_r = (
+            self.proj_b(f_or_z).unflatten(-2, (4, n)).unbind(-3)
+        )
+
+        geom = torch.einsum("ijk, ...j, ...k -> ...i", self.basis_gp, geom_l, geom_r)
+        join = torch.einsum("ijk, ...j, ...k -> ...i", self.basis_jn, join_l, join_r)
+        if r is not None:
+            join = join * r[..., 14:15]
+
+        f_or_z = torch.cat([geom, join], dim=-2)
         return self.proj_o(f_or_z)
 
 
@@ -354,6 +384,14 @@ class FaceTokenModel(nn.Module):
         self.encoder.apply(partial(self._init_params, n=config.num_encoder_layers))
         self.decoder.apply(partial(self._init_params, n=config.num_decoder_layers))
 
+        # Each layer is a chain of tiny einsums and point-wise ops, so it is bound by
+        #     kernel launch latency rather than compute. Compiling the layers lets
+        #     Inductor fuse the norm/activation/residual chains and replay the whole
+        #     layer as a CUDA graph.
+        if config.compile_layers:
+            for layer in (*self.encoder, *self.decoder):
+                layer.compile(mode="reduce-overhead", fullgraph=True)
+
     def _init_params(self, m: nn.Module, n: int = 1) -> None:
         r"""Initialize layers with modified kaiming normal.
 
@@ -406,14 +444,22 @@ class FaceTokenModel(nn.Module):
         tuple[torch.Tensor]
             Reconstructed face, encoded face, codebook codes, in that order.
         """
-        r = r or torch.mean(f, keepdim=True, dim=(1,))
+        if self.config.compile_layers:
+            torch.compiler.cudagraph_mark_step_begin()
+
+        # Do not use ``r or ...`` here: truth-testing a tensor forces a device sync
+        #     (and raises for multi-element tensors).
+        if r is None:
+            r = torch.mean(f, keepdim=True, dim=(1,))
 
         # Explanation of namings:
         #    - 'x': Encoded faces, i.e., the ``Proj_x(z_e(x))``.
         #    - 'e': Nearest codebook code from 'x', i.e., the ``e_k``.
         #    - 's': Numerically the same as 'e', used for straight-through gradient.
         #    - 'z': Latent input for decoder, i.e., the ``Proj_z(z_q(x))``.
-        f = reduce(lambda f, l: l(f, r), self.encoder, self.proj_i(f))
+        f = self.proj_i(f)
+        for layer in self.encoder:
+            f = layer(f, r)
         x = self.proj_x(f)
 
         # Lookup the codebook to get the latent representations.
@@ -425,7 +471,9 @@ class FaceTokenModel(nn.Module):
 
         # Use the average multi-vector across (projected) latent channels as reference.
         r = torch.mean(z, keepdim=True, dim=(1,)).detach()
-        p = reduce(lambda z, l: l(z, r), self.decoder, z)
+        p = z
+        for layer in self.decoder:
+            p = layer(p, r)
         return self.proj_o(p), x, e
 
     @torch.no_grad
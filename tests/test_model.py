@@ -0,0 +1,36 @@
+import pytest
+import torch
+from ezgatr.nn.functional import equi_join, geometric_product
+
+from factok.model import FaceTokenBilinear, FaceTokenConfig
+
+
+@pytest.fixture
+def bilinear() -> FaceTokenBilinear:
+    return FaceTokenBilinear(FaceTokenConfig())
+
+
+def test_basis_gp_matches_geometric_product(bilinear):
+    torch.manual_seed(0)
+    x, y = torch.randn(2, 3, 5, 16)
+
+    ret = torch.einsum("ijk, ...j, ...k -> ...i", bilinear.basis_gp, x, y)
+    torch.testing.assert_close(ret, geometric_product(x, y))
+
+
+@pytest.mark.parametrize("with_reference", [True, False])
+def test_basis_jn_matches_equi_join(bilinear, with_reference):
+    torch.manual_seed(0)
+    x, y = torch.randn(2, 3, 5, 16)
+    r = torch.randn(3, 1, 16) if with_reference else None
+
+    ret = torch.einsum("ijk, ...j, ...k -> ...i", bilinear.basis_jn, x, y)
+    if r is not None:
+        ret = ret * r[..., 14:15]
+    torch.testing.assert_close(ret, equi_join(x, y, r))
+
+
+def test_bilinear_forward_without_reference(bilinear):
+    config = bilinear.config
+    ret = bilinear(torch.randn(2, config.hidden_size, 16), None)
+    assert ret.shape == (2, config.hidden_size, 16)